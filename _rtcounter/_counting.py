@@ -1,12 +1,41 @@
-import HTSeq as ht
+import array
+import cgranges as cr
 import collections as co
-import datetime as dt
+import csv
+import functools as ft
+import logging
+import multiprocessing as mp
+import numpy as np
+import os
 import pandas as pd
+import pysam
+import time
 
-# CIGAR data
-MOPS=set(["M","=","X"]) # CIGAR operations interpreted as matches
-SOPS=set(["N"]) # CIGAR operations interpreted as skips
-ROPS=set(["M","=","X","N","D"]) # Reference-consuming CIGAR operations
+# Private modules
+from _rtcounter import _io
+
+# CIGAR data, as bitmasks over the pysam integer operation codes
+# An operation code op is in a mask if (mask>>op)&1
+MOPS_MASK=(1<<pysam.CMATCH)|(1<<pysam.CEQUAL)|(1<<pysam.CDIFF) # M, =, X
+SOPS_MASK=1<<pysam.CREF_SKIP # N
+ROPS_MASK=MOPS_MASK|SOPS_MASK|(1<<pysam.CDEL) # Reference-consuming
+
+# SAM flags
+FLAG_PROPER_PAIR=0x2
+FLAG_FAIL_CHECKS=0x604 # Unmapped, failing platform QC, or duplicate
+
+# Feature file data
+GFF_COLUMNS=["chrom","source","type","start","end","score","strand","frame",
+        "attr"]
+# The value of the first attribute, in which GTF values may be quoted
+RE_NAME_GTF=r'^\s*[^\s=]+[\s=]+(?:"([^"]*)"|([^;]*))'
+RE_NAME_GFF3=r'^\s*[^\s=]+[\s=]+([^;]*)'
+
+# Feature id marking an overlap of more than one feature
+ID_MULTI=-1
+
+# Integer codes of the strands
+STRANDS={"+":1,"-":-1,".":0}
 
 # Miscellaneous constants
 ERROR_CODES={
@@ -18,8 +47,25 @@ ERROR_CODES={
         "INSUFF_MATCH":6,
         "UPSTREAM_MATCH":7,
         "DOWNSTREAM_MATCH":8}
-
-def _calc_rt(pathToGTF,pathToBAM,pathToHits,pathToFails,fAnchor):
+# Optional fields of failing templates, keyed by error, built once
+OPTS_FAILS={code:[["xx","i",val]] for code,val in ERROR_CODES.items()}
+SIZE_CHUNK=10000 # Number of bundles classified together
+SIZE_CHUNK_GTF=1<<16 # Number of feature file lines parsed together
+SIZE_CACHE_OVERLAP=4096 # Maximum number of cached exon index queries
+SIZE_CACHE_CIGAR=1<<16 # Maximum number of cached CIGAR scans
+THREADS_READ=min(4,os.cpu_count() or 1) # BGZF decompression threads
+THREADS_WRITE=4 # Number of BGZF compression threads of each BAM writer
+SIZE_PROGRESS=10000 # Number of templates between checks of the clock
+SECONDS_PROGRESS=30.0 # Minimum number of seconds between progress updates
+
+# Messages are logged here, and formatted by the caller's logging handlers
+LOGGER=logging.getLogger("rtcounter")
+
+# The feature data used by _classify_chunk, set by _init_worker
+_STATE={}
+
+def _calc_rt(pathToGTF,pathToBAM,pathToHits,pathToFails,fAnchor,nProc=1,
+        pathToCache=None):
     """
     Counts paired-end reads from a BAM file using the following procedure:
     1. A template counts toward the 'base' transcript of a feature F if:
@@ -68,7 +114,7 @@ def _calc_rt(pathToGTF,pathToBAM,pathToHits,pathToFails,fAnchor):
 
     (ii)
     A dictionary in which each id from the dataframe is a key whose value
-    is a list of the tail lengths.
+    is an array.array of the tail lengths.
 
     SAM file reading follows "Sequence Alignment/Map Format Specification"
     updated April 30, 2020 from the SAM/BAM Format Specification Working Group.
@@ -84,281 +130,626 @@ def _calc_rt(pathToGTF,pathToBAM,pathToHits,pathToFails,fAnchor):
     to this path and file. Alignments are written in SAM format with 1 added 
     optional field:
     1. xx:i:ERROR_CODE
+
+    If nProc is greater than 1, templates are classified in chunks by a pool
+    of nProc worker processes, while this process reads the BAM file and
+    writes the results.
+
+    If pathToCache is specified, the features read from pathToGTF are cached
+    at this path, and read from it instead on later runs while pathToGTF is
+    unchanged.
     """
 
-    _msg("Reading feature file...")
-    ff=ht.GFF_Reader(pathToGTF,end_included=True)
-    exons=ht.GenomicArrayOfSets("auto",stranded=False)
-    # The ivBounds dictionary has feature names as its keys and values
-    # consisting of genomic intervals encompassing all exons with each name,
-    # but only exons that have an associated strand + or -
-    ivBounds={}
-    for feature in ff:
-        if feature.type=="exon":
-            exons[feature.iv]+=feature.name
-            if feature.iv.strand!=".":
-                if (feature.name not in ivBounds.keys()):
-                    ivBounds[feature.name]=feature.iv
-                else:
-                    ivBounds[feature.name].extend_to_include(feature.iv)
-    _msg("".join(["Read ",str(len(ivBounds.keys()))," named sets of exons."]))
-
-    cntStats=co.Counter() # Counter of template statistics
-    cntBase=co.Counter() # Counter of base transcripts
-    cntRT=co.Counter() # Counter of readthrough transcripts
-    dictTails=co.defaultdict(list) # Lists of tail lengths for each feature name
+    # Read the features from the cache if it is current, or else from the
+    # feature file
+    features=None
+    if pathToCache is not None:
+        features=_io._file2features(pathToCache,pathToGTF)
+        if features is not None:
+            _msg("Read features from cache.")
+    if features is None:
+        features=_read_features(pathToGTF)
+        if pathToCache is not None:
+            _io._features2file(pathToCache,pathToGTF,*features)
+    listNames,dictExons,ivBounds=features
+
+    # Counts of rejected templates, indexed by the values of ERROR_CODES
+    # Hits are counted from cntBase and cntRT, and pairs by nPairs
+    cntStats=[0]*(max(ERROR_CODES.values())+1)
+    # Counts of base and readthrough transcripts, indexed by feature id
+    cntBase=np.zeros(len(listNames),dtype=np.int64)
+    cntRT=np.zeros(len(listNames),dtype=np.int64)
+    # Feature ids in the order of their first base hit, for the output rows
+    listHitIds=[]
+    # Tail lengths for each feature name, in arrays of C ints
+    dictTails=co.defaultdict(ft.partial(array.array,"i"))
     
-    aa=ht.SAM_Reader(pathToBAM)
-    if pathToHits is not None:
-        w_hits=ht.BAM_Writer.from_BAM_Reader(pathToHits,aa)
+    # Classify templates in this process or in a pool of worker processes
+    # The pool is started before any BAM file is opened, so that no worker
+    # inherits an htslib handle or its threads
+    if nProc>1:
+        pool=mp.Pool(nProc,initializer=_init_worker,
+                initargs=(dictExons,ivBounds,fAnchor,listNames))
+    else:
+        pool=None
+        _init_worker(dictExons,ivBounds,fAnchor,listNames)
+
+    # The pool and all BAM files are released however the counting ends
+    aa=w_hits=w_fails=None
+    try:
+        aa=pysam.AlignmentFile(pathToBAM,"rb",threads=THREADS_READ)
+        # Mates are paired by read name, so coordinate-sorted files are
+        # rejected
+        if aa.header.to_dict().get("HD",{}).get("SO")=="coordinate":
+            raise ValueError("".join(["BAM file ",pathToBAM," is sorted by ",
+                "coordinate, but must be sorted by read name."]))
+        if pathToHits is not None:
+            w_hits=pysam.AlignmentFile(pathToHits,"wb",template=aa,
+                    threads=THREADS_WRITE)
+        if pathToFails is not None:
+            w_fails=pysam.AlignmentFile(pathToFails,"wb",template=aa,
+                    threads=THREADS_WRITE)
+
+        _msg("Started counting reads...")
+
+        # Bind the globals used for every template to locals
+        write=writeBAMwithOpts
+        optsFails=OPTS_FAILS
+        optsMulti=OPTS_FAILS["MULTI_MAP"]
+
+        errorCodes=ERROR_CODES
+        codeMulti=ERROR_CODES["MULTI_MAP"]
+
+        nPairs=0 # Count of read pairs
+        timeProgress=time.monotonic()
+
+        for bundle,listResults in _classify_bundles(
+                _io._bundle_pairs(aa.fetch(until_eof=True)),pool,2*nProc):
+
+            # Progress update, at most once every SECONDS_PROGRESS seconds
+            nPairs+=1
+            if nPairs%SIZE_PROGRESS==0 and \
+                    time.monotonic()-timeProgress>=SECONDS_PROGRESS:
+                timeProgress=time.monotonic()
+                _msg("".join(["In progress: Counted ",str(nPairs),
+                    " read pairs, ",str(cntBase.sum())," base hits, and ",
+                    str(cntRT.sum())," readthrough hits."]))
+
+            # Reject multimappers
+            if len(bundle)>1:
+                cntStats[codeMulti]+=1
+                if w_fails is not None:
+                    for pair in bundle:
+                        write(w_fails,pair,optsMulti)
+                continue
+
+            for pair,(code,idBase,lenBase,lenRT) in zip(bundle,listResults):
+
+                # Reject templates that fail any criterion
+                if code is not None:
+                    cntStats[errorCodes[code]]+=1
+                    if w_fails is not None:
+                        write(w_fails,pair,optsFails[code])
+                    continue
+
+                # Increment counters
+                if cntBase[idBase]==0:
+                    listHitIds.append(idBase)
+                cntBase[idBase]+=1
+                if lenRT>0:
+                    cntRT[idBase]+=1
+                    dictTails[listNames[idBase]].append(lenRT)
+
+                # Write the hit
+                if w_hits is not None:
+                    opts=[["fe","Z",listNames[idBase]],["ba","i",lenBase]]
+                    if lenRT>0:
+                        opts.append(["tl","i",lenRT])
+                    write(w_hits,pair,opts)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+        for af in (aa,w_hits,w_fails):
+            if af is not None:
+                af.close()
+
+    # Collect the statistics by name for the summary
+    dictStats={code:cntStats[val] for code,val in ERROR_CODES.items()}
+    dictStats["TOT_PAIRS"]=nPairs
+    dictStats["TOT_BASE"]=int(cntBase.sum())
+    dictStats["TOT_RT"]=int(cntRT.sum())
+
+    _msg("".join(["Finished counting reads.","\n\t","Summary of results:",
+        "\n\t","Total reads from file: ",str(dictStats["TOT_PAIRS"]),"\n\t",
+        "Total base hits: ",str(dictStats["TOT_BASE"]),"\n\t",
+        "Total readthrough hits: ",str(dictStats["TOT_RT"]),"\n\t",
+        "Total multi-mapping reads: ",str(dictStats["MULTI_MAP"]),"\n\t",
+        "Total orphan reads: ",str(dictStats["ORPHAN"]),"\n\t",
+        "Total reads failing checks: ",str(dictStats["FAIL_CHECKS"]),"\n\t",
+        "Total reads matching no feature name: ",str(dictStats["NO_NAME"]),
+        "\n\t",
+        "Total reads matching multiple names: ",str(dictStats["MULTI_NAME"]),
+        "\n\t",
+        "Total reads with too few matches: ",str(dictStats["INSUFF_MATCH"]),
+        "\n\t",
+        "Total reads with upstream match: ",str(dictStats["UPSTREAM_MATCH"]),
+        "\n\t",
+        "Total reads with downstream match but failing readthrough: ",
+        str(dictStats["DOWNSTREAM_MATCH"])]))
+
+    # Construct dataframe of the features with at least one base hit, in the
+    # order of their first hit
+    arrHitIds=np.array(listHitIds,dtype=np.int64)
+    dfCnt=pd.DataFrame({"id":np.array(listNames,dtype=object)[arrHitIds],
+        "count_base":cntBase[arrHitIds],
+        "count_readthrough":cntRT[arrHitIds]})
+    return dfCnt,dictTails
+
+def _read_features(pathToGTF):
+    """
+    Read the exons of each named feature from a feature file.
+    pathToGTF: the path to a GTF or GFF3 feature file, which may be gzipped
+    Returns a (NAMES,EXONS,BOUNDS) tuple, in which NAMES is a list of the
+    feature names indexed by feature id, EXONS is a dictionary of exon
+    coordinates, as used by _index_exons, and BOUNDS is a (START,END,STRAND)
+    tuple of arrays of the feature bounds, indexed by feature id, with STRAND
+    given as a value of STRANDS.
+    """
+
+    _msg("Reading feature file...")
+    # Feature files are read as in HTSeq.GFF_Reader with end_included=True:
+    # GTF files are those with a .gtf extension, and other files are read as
+    # GFF3, whose attribute values are not quoted
+    pathLower=pathToGTF.lower()
+    isGTF=pathLower.endswith((".gtf",".gtf.gz",".gtf.gzip"))
+    # The file is read in chunks of SIZE_CHUNK_GTF lines, each reduced to its
+    # exons and their names before the next is read, so that neither the
+    # other rows nor the attribute strings are held in memory at once
+    listChunks=[]
+    with pd.read_csv(pathToGTF,sep="\t",header=None,names=GFF_COLUMNS,
+            usecols=["chrom","type","start","end","strand","attr"],dtype=str,
+            quoting=csv.QUOTE_NONE,chunksize=SIZE_CHUNK_GTF,
+            compression="gzip" if pathLower.endswith((".gz",".gzip")) else None
+            ) as itChunks:
+        for dfGTF in itChunks:
+            dfGTF=dfGTF[(dfGTF["type"]=="exon") & \
+                    ~dfGTF["chrom"].str.startswith("#")]
+            if not dfGTF["strand"].isin(STRANDS.keys()).all():
+                raise ValueError("Exons must have a strand of +, - or '.'.")
+            # Each feature is named by the value of its first attribute
+            if isGTF:
+                dfName=dfGTF["attr"].str.extract(RE_NAME_GTF)
+                seriesNames=dfName[0].fillna(dfName[1])
+            else:
+                seriesNames=dfGTF["attr"].str.extract(RE_NAME_GFF3)[0]
+            listChunks.append(pd.DataFrame({
+                "chrom":dfGTF["chrom"].to_numpy(),
+                "name":seriesNames.fillna("_unnamed_").to_numpy(),
+                "start":dfGTF["start"].astype(np.int64).to_numpy()-1,
+                "end":dfGTF["end"].astype(np.int64).to_numpy(),
+                "strand":dfGTF["strand"].to_numpy()}))
+            del dfGTF
+    if len(listChunks)>0:
+        dfExons=pd.concat(listChunks,ignore_index=True)
     else:
-        w_hits=None
-    if pathToFails is not None:
-        w_fails=ht.BAM_Writer.from_BAM_Reader(pathToFails,aa)
+        dfExons=pd.DataFrame({"chrom":[],"name":[],
+            "start":np.zeros(0,dtype=np.int64),
+            "end":np.zeros(0,dtype=np.int64),"strand":[]})
+    del listChunks
+    # Each feature name is assigned an integer id, its position in listNames
+    arrIds,indexNames=pd.factorize(dfExons["name"])
+    listNames=indexNames.tolist()
+    dfExons["id"]=arrIds
+    dfExons=dfExons.drop(columns="name")
+    # The dictExons dictionary has (chromosome, feature id) tuples as its
+    # keys and values consisting of lists of (start, end) exon coordinates
+    dictExons=co.defaultdict(list)
+    for chrom,idFeat,start,end in zip(dfExons["chrom"].tolist(),
+            dfExons["id"].tolist(),dfExons["start"].tolist(),
+            dfExons["end"].tolist()):
+        dictExons[(chrom,idFeat)].append((start,end))
+    # The bounds encompass all exons with each name, but only exons that have
+    # a strand + or -
+    dfBounds=dfExons[dfExons["strand"]!="."].groupby("id").agg(
+            chrom=("chrom","first"),nChrom=("chrom","nunique"),
+            start=("start","min"),end=("end","max"),
+            strand=("strand","first"),nStrand=("strand","nunique"))
+    isMixed=(dfBounds["nChrom"]>1) | (dfBounds["nStrand"]>1)
+    if isMixed.any():
+        raise ValueError("".join(["Exons of feature ",
+            listNames[dfBounds.index[isMixed][0]],
+            " lie on more than one chromosome or strand."]))
+    _msg("".join(["Read ",str(len(dfBounds))," named sets of exons."]))
+    # Reduce the bounds to parallel (START,END,STRAND) arrays indexed by
+    # feature id, with the strand as an integer, which are compact and cheap
+    # to send to worker processes
+    # Features without a stranded exon keep a strand of 0
+    arrStart=np.zeros(len(listNames),dtype=np.int64)
+    arrEnd=np.zeros(len(listNames),dtype=np.int64)
+    arrStrand=np.zeros(len(listNames),dtype=np.int8)
+    arrStart[dfBounds.index]=dfBounds["start"].to_numpy()
+    arrEnd[dfBounds.index]=dfBounds["end"].to_numpy()
+    arrStrand[dfBounds.index]=dfBounds["strand"].map(STRANDS).to_numpy()
+    ivBounds=(arrStart,arrEnd,arrStrand)
+    return listNames,dictExons,ivBounds
+
+def _index_exons(dictExons):
+    """
+    Build a cgranges interval index of exons.
+    dictExons: a dictionary with (CHROM,ID) keys and values consisting of
+        lists of (START,END) exon coordinates, where ID is a feature id
+    Exons sharing a feature id are merged so that no two intervals with the
+    same id overlap. Each interval in the index is labeled by its feature id.
+    """
+
+    exons=cr.cgranges()
+    for (chrom,idFeat),listIv in dictExons.items():
+        listIv.sort()
+        start,end=listIv[0]
+        for st,en in listIv[1:]:
+            if st>end:
+                exons.add(chrom,start,end,idFeat)
+                start=st
+            if en>end:
+                end=en
+        exons.add(chrom,start,end,idFeat)
+    exons.index()
+    return exons
+
+def _init_worker(dictExons,ivBounds,fAnchor,listNames):
+    """
+    Prepare the current process to classify templates with _classify_chunk.
+    dictExons: a dictionary of exon coordinates, as used by _index_exons
+    ivBounds: a (START,END,STRAND) tuple of arrays of the feature bounds,
+        indexed by feature id, with STRAND given as a value of STRANDS
+    fAnchor: the minimum overlap length of a base match
+    listNames: a list of the feature names, indexed by feature id, used to
+        name features in errors
+    """
+
+    _STATE["exons"]=_index_exons(dictExons)
+    _overlap.cache_clear()
+    _STATE["ivBounds"]=ivBounds
+    _STATE["fAnchor"]=fAnchor
+    _STATE["names"]=listNames
+
+def _classify_bundles(itBundles,pool,nPending):
+    """
+    Classify the templates in bundles of mates, in chunks of SIZE_CHUNK
+    bundles.
+    itBundles: an iterator of bundles, as yielded by _io._bundle_pairs
+    pool: a multiprocessing pool whose workers were prepared by _init_worker,
+        or None to classify in the current process
+    nPending: the maximum number of chunks submitted to the pool but not yet
+        yielded
+    Yields (BUNDLE,RESULTS) tuples in the original order of the bundles, in
+    which RESULTS is a list with one result of _classify for each template in
+    the bundle. Multimapper bundles are not classified and have no results.
+    """
+
+    dequeTasks=co.deque()
+    for listBundles in _io._chunk(itBundles,SIZE_CHUNK):
+        listPrims=[]
+        for bundle in listBundles:
+            if len(bundle)>1:
+                listPrims.append([])
+            else:
+                listPrims.append([_pair_prims(pair) for pair in bundle])
+        if pool is None:
+            listResults=_classify_chunk(listPrims)
+        else:
+            listResults=pool.apply_async(_classify_chunk,(listPrims,))
+        dequeTasks.append((listBundles,listResults))
+        while len(dequeTasks)>nPending:
+            listBundles,listResults=dequeTasks.popleft()
+            if pool is not None:
+                listResults=listResults.get()
+            yield from zip(listBundles,listResults)
+    while len(dequeTasks)>0:
+        listBundles,listResults=dequeTasks.popleft()
+        if pool is not None:
+            listResults=listResults.get()
+        yield from zip(listBundles,listResults)
+
+def _pair_prims(pair):
+    """
+    Extract the data needed by _classify from a pair of mates.
+    pair: a (FIRST,SECOND) tuple of pysam alignments, in which a missing mate
+        is None
+    Returns a tuple with a (CHROM,START,END,CIGAR) tuple for each mate, in
+    which CIGAR is a tuple of (OPERATION,LENGTH) tuples.
+    Templates that are orphans or fail the alignment checks are rejected
+    before their CIGARs are read, and the key of their error in ERROR_CODES
+    is returned instead.
+    """
+
+    # Check that the alignment is paired
+    if None in pair:
+        return "ORPHAN"
+
+    # Check that all segments are aligned and properly paired, testing the
+    # flags of both mates at once
+    flag1=pair[0].flag
+    flag2=pair[1].flag
+    if ((flag1|flag2) & FLAG_FAIL_CHECKS) or \
+            not (flag1 & flag2 & FLAG_PROPER_PAIR):
+        return "FAIL_CHECKS"
+
+    return tuple((seg.reference_name,seg.reference_start,seg.reference_end,
+        tuple(seg.cigartuples)) for seg in pair)
+
+def _classify_chunk(listPrims):
+    """
+    Classify a chunk of templates with the feature data set by _init_worker.
+    listPrims: a list with a list of templates for each bundle, in which each
+        template is given as returned by _pair_prims
+    Returns a list with a list of results of _classify for each bundle.
+    """
+
+    ivBounds=_STATE["ivBounds"]
+    fAnchor=_STATE["fAnchor"]
+    return [[_classify(prims,ivBounds,fAnchor) for prims in bundle]
+            for bundle in listPrims]
+
+def _classify(prims,ivBounds,fAnchor):
+    """
+    Apply the counting criteria described in _calc_rt to one template.
+    prims: a template, as returned by _pair_prims
+    ivBounds: a (START,END,STRAND) tuple of arrays of the feature bounds,
+        indexed by feature id, with STRAND given as a value of STRANDS
+    fAnchor: the minimum overlap length of a base match
+    Returns a (CODE,ID,LEN_BASE,LEN_RT) tuple, in which CODE is a key of
+    ERROR_CODES if the template is rejected and None otherwise, ID is the
+    matched feature id, LEN_BASE is the count of match operations
+    supporting the base transcript, and LEN_RT is the tail length.
+    """
+
+    # Templates rejected by _pair_prims carry only their error
+    if isinstance(prims,str):
+        return (prims,None,0,0)
+
+    # Identify a unique feature name for the template, if it exists, and
+    # the largest supporting match operation count of any segment
+    idBase=None
+    lenBase=0
+    for chrom,start,end,cigar in prims:
+        idSeg,lenSeg=_count_segment(chrom,start,cigar)
+        if idSeg is None:
+            continue
+        # Check if the segments overlap multiple feature names
+        if idSeg==ID_MULTI or (idBase is not None and idSeg!=idBase):
+            return ("MULTI_NAME",None,0,0)
+        idBase=idSeg
+        if lenSeg>lenBase:
+            lenBase=lenSeg
+    # Check if any segment overlaps any feature name
+    if idBase is None:
+        return ("NO_NAME",None,0,0)
+    # Check if the overlap length is sufficient to declare a base match
+    if lenBase<fAnchor:
+        return ("INSUFF_MATCH",None,0,0)
+
+    # Apply the upstream and readthrough criteria with the function
+    # specialized for the strand of the matched name
+    sBase=ivBounds[2].item(idBase)
+    if sBase>0:
+        code,lenRT=_tail_plus(prims,ivBounds[0].item(idBase),
+                ivBounds[1].item(idBase))
+    elif sBase<0:
+        code,lenRT=_tail_minus(prims,ivBounds[0].item(idBase),
+                ivBounds[1].item(idBase))
     else:
-        w_fails=None
+        raise ValueError("".join(["Feature ",_STATE["names"][idBase],
+            " has no exons with a strand + or -."]))
+    if code is not None:
+        return (code,None,0,0)
+
+    return (None,idBase,lenBase,lenRT)
 
-    _msg("Started counting reads...")
+def _tail_plus(prims,startBase,endBase):
+    """
+    Apply the upstream and readthrough criteria described in _calc_rt to a
+    template matching a feature on the + strand.
+    prims: a template, as returned by _pair_prims
+    startBase, endBase: the bounds of the matched feature
+    Returns a (CODE,LEN_RT) tuple, in which CODE is a key of ERROR_CODES if
+    the template is rejected and None otherwise, and LEN_RT is the tail
+    length.
+    """
 
-    for bundle in ht.pair_SAM_alignments(aa,bundle=True):
+    # Identify upstream matches (upstream of the most upstream exon)
+    for chrom,start,end,cigar in prims:
+        if start<startBase:
+            return ("UPSTREAM_MATCH",0)
 
-        # Progress update
-        cntStats["TOT_PAIRS"]+=1
-        if cntStats["TOT_PAIRS"]>0 and cntStats["TOT_PAIRS"]%100000==0:
-            _msg("".join(["In progress: Counted ",str(cntStats["TOT_PAIRS"]),
-                " read pairs, ",str(cntStats["TOT_BASE"])," base hits, and ",
-                str(cntStats["TOT_RT"])," readthrough hits."]))
+    # Identify readthrough (downstream of the most downstream exon)
+    lenRT=0 # The longest tail length of any segment
+    isDown=False # Set to True if we find a downstream match
+    for chrom,start,end,cigar in prims:
 
-        # Reject multimappers
-        if len(bundle)>1:
-            cntStats["MULTI_MAP"]+=1
-            for pair in bundle:
-                writeBAMwithOpts(
-                    w_fails,pair,[["xx","i",ERROR_CODES["MULTI_MAP"]]])
+        # Check if the segment spans downstream of the exons at all
+        if end<=endBase:
             continue
 
-        for pair in bundle:
+        isDown=True
 
-            # Check that the alignment is paired
-            if None in pair:
-                cntStats["ORPHAN"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,[["xx","i",ERROR_CODES["ORPHAN"]]])
+        # Walk downstream through the reference-consuming operations. Their
+        # ends only increase, so the readthrough interval ends at the last
+        # non-skip operation past endBase before the first skip past it.
+        opEnd=start
+        endRT=endBase
+        for op,length in cigar:
+            if not (ROPS_MASK>>op)&1:
                 continue
-
-            # Check that all segments are aligned and properly paired
-            failchecks=False
-            for seg in pair:
-                if ((not seg.aligned) or \
-                        seg.failed_platform_qc or \
-                        seg.pcr_or_optical_duplicate or \
-                        (not seg.proper_pair)):
-                    failchecks=True
+            opEnd+=length
+            if opEnd>endBase:
+                if (SOPS_MASK>>op)&1: # Stop counting
+                    if endRT-endBase>lenRT:
+                        lenRT=endRT-endBase
                     break
-            if failchecks:
-                failchecks=False
-                cntStats["FAIL_CHECKS"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,[["xx","i",ERROR_CODES["FAIL_CHECKS"]]])
-                continue
+                endRT=opEnd
 
-            # Identify a unique feature name for the template, if it exists
-            # Identify feature names and the supporting match operation counts
-            listCntNames=[]
-            namesBase=set()
-            isMultiName=False # Set to True if an op overlaps multiple names
-            for seg in pair:
-                cntNames=co.Counter()
-                for op in seg.cigar:
-                    if op.type in MOPS:
-                        for iv,names in exons[op.ref_iv].steps():
-                            if len(names)>1:
-                                isMultiName=True
-                                break
-                            for name in names:
-                                cntNames[name]+=iv.length
-                    if isMultiName:
-                        break
-                if isMultiName:
-                    break
-                namesBase |= set(cntNames.keys())
-                listCntNames.append(cntNames)
-            # Check if any segment overlaps multiple feature names
-            if isMultiName or len(namesBase)>1:
-                cntStats["MULTI_NAME"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,[["xx","i",ERROR_CODES["MULTI_NAME"]]])
-                continue
-            # Check if any segment overlaps any feature name
-            if len(namesBase)==0:
-                cntStats["NO_NAME"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,[["xx","i",ERROR_CODES["NO_NAME"]]])
-                continue
-            # Check if the overlap length is sufficient to declare a base match
-            nameBase=list(namesBase)[0]
-            lenBase=0
-            for cntNames in listCntNames:
-                if cntNames[nameBase]>lenBase:
-                    lenBase=cntNames[nameBase]
-            if lenBase<fAnchor:
-                cntStats["INSUFF_MATCH"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,[["xx","i",ERROR_CODES["INSUFF_MATCH"]]])
-                continue
+    # Check if we have a downstream match but not a readthrough hit
+    if isDown and lenRT==0:
+        return ("DOWNSTREAM_MATCH",0)
 
-            # Extract information about the matched name
-            ivBase=ivBounds[nameBase]
-            sBase=ivBase.strand
+    return (None,lenRT)
 
-            # Identify upstream matches (upstream of the most upstream exon)
-            isUp=False # Set to True if we find an upstream match
-            for seg in pair:
-                if ((sBase=="+" and seg.iv.start<ivBase.start) or \
-                        (sBase=="-" and seg.iv.end>ivBase.end)):
-                    isUp=True
-                    break
-            if isUp:
-                cntStats["UPSTREAM_MATCH"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,
-                        [["xx","i",ERROR_CODES["UPSTREAM_MATCH"]]])
-                continue
+def _tail_minus(prims,startBase,endBase):
+    """
+    Apply the upstream and readthrough criteria described in _calc_rt to a
+    template matching a feature on the - strand.
+    prims: a template, as returned by _pair_prims
+    startBase, endBase: the bounds of the matched feature
+    Returns a (CODE,LEN_RT) tuple, as returned by _tail_plus.
+    """
 
-            # Identify readthrough (downstream of the most downstream exon)
-            listLenRT=[0]
-            isDown=False # Set to True if we find a downstream match
-            for seg in pair:
+    # Identify upstream matches (upstream of the most upstream exon)
+    for chrom,start,end,cigar in prims:
+        if end>endBase:
+            return ("UPSTREAM_MATCH",0)
 
-                # Check if the segment spans downstream of the exons at all
-                if ((sBase=="+" and seg.iv.end<=ivBase.end) or \
-                        (sBase=="-" and seg.iv.start>=ivBase.start)):
-                    continue
+    # Identify readthrough (downstream of the most downstream exon)
+    lenRT=0 # The longest tail length of any segment
+    isDown=False # Set to True if we find a downstream match
+    for chrom,start,end,cigar in prims:
+
+        # Check if the segment spans downstream of the exons at all
+        if start>=startBase:
+            continue
+
+        isDown=True
 
-                isDown=True
-                
-                # Construct an interval of length 0, to be included to include
-                # any CIGAR operations that qualify as readthrough
-                if sBase=="+":
-                    posBoundOut=ivBase.end
-                elif sBase=="-":
-                    posBoundOut=ivBase.start
-                ivRT=ht.GenomicInterval(
-                        ivBase.chrom,posBoundOut,posBoundOut,".")
-
-                # Construct a downstream iterator through the CIGAR
-                if sBase=="+":
-                    itCIGAR=seg.cigar
-                elif sBase=="-":
-                    itCIGAR=reversed(seg.cigar)
-
-                # Update ivRT to include any readthrough
-                isReading=False # True if we are in readthrough operations
-                for op in itCIGAR:
-                    if op.type in ROPS:
-                        if ((sBase=="+" and op.ref_iv.end>ivBase.end) or \
-                                (sBase=="-" and op.ref_iv.start<ivBase.start)):
-                            isReading=True
-                            if op.type not in SOPS:
-                                ivRT.extend_to_include(op.ref_iv)
-                        if (isReading and (op.type in SOPS)): # Stop counting
-                            # Correct the upstream bound of ivRT
-                            if sBase=="+":
-                                ivRT.start=ivBase.end
-                            elif sBase=="-":
-                                ivRT.end=ivBase.start
-                            listLenRT.append(ivRT.length)
-                            break
-            lenRT=max(listLenRT)
-
-            # Check if we have a downstream match but not a readthrough hit
-            if isDown and lenRT==0:
-                cntStats["DOWNSTREAM_MATCH"]+=1
-                writeBAMwithOpts(
-                        w_fails,pair,
-                        [["xx","i",ERROR_CODES["DOWNSTREAM_MATCH"]]])
+        # Walk downstream, from the right end of the segment, through the
+        # reference-consuming operations. Their starts only decrease, so the
+        # readthrough interval starts at the last non-skip operation past
+        # startBase before the first skip past it.
+        opStart=end
+        startRT=startBase
+        for op,length in reversed(cigar):
+            if not (ROPS_MASK>>op)&1:
                 continue
+            opStart-=length
+            if opStart<startBase:
+                if (SOPS_MASK>>op)&1: # Stop counting
+                    if startBase-startRT>lenRT:
+                        lenRT=startBase-startRT
+                    break
+                startRT=opStart
 
-            # Increment counters
-            cntBase[nameBase]+=1
-            cntStats["TOT_BASE"]+=1
-            if lenRT>0:
-                cntRT[nameBase]+=1
-                cntStats["TOT_RT"]+=1
-                dictTails[nameBase].append(lenRT)
-
-            # Write the hit
-            if pathToHits is not None:
-                opts=[["fe","Z",nameBase],["ba","i",lenBase]]
-                if lenRT>0:
-                    opts.append(["tl","i",lenRT])
-                writeBAMwithOpts(w_hits,pair,opts)
+    # Check if we have a downstream match but not a readthrough hit
+    if isDown and lenRT==0:
+        return ("DOWNSTREAM_MATCH",0)
 
-    if pathToHits is not None:
-        w_hits.close()
-    if pathToFails is not None:
-        w_fails.close()
+    return (None,lenRT)
 
-    _msg("".join(["Finished counting reads.","\n\t","Summary of results:",
-        "\n\t","Total reads from file: ",str(cntStats["TOT_PAIRS"]),"\n\t",
-        "Total base hits: ",str(cntStats["TOT_BASE"]),"\n\t",
-        "Total readthrough hits: ",str(cntStats["TOT_RT"]),"\n\t",
-        "Total multi-mapping reads: ",str(cntStats["MULTI_MAP"]),"\n\t",
-        "Total orphan reads: ",str(cntStats["ORPHAN"]),"\n\t",
-        "Total reads failing checks: ",str(cntStats["FAIL_CHECKS"]),"\n\t",
-        "Total reads matching no feature name: ",str(cntStats["NO_NAME"]),
-        "\n\t",
-        "Total reads matching multiple names: ",str(cntStats["MULTI_NAME"]),
-        "\n\t",
-        "Total reads with too few matches: ",str(cntStats["INSUFF_MATCH"]),
-        "\n\t",
-        "Total reads with upstream match: ",str(cntStats["UPSTREAM_MATCH"]),
-        "\n\t",
-        "Total reads with downstream match but failing readthrough: ",
-        str(cntStats["DOWNSTREAM_MATCH"])]))
-
-    # Add zeros to cntRT dictionary to prepare for dataframe
-    for key in cntBase.keys():
-        if key not in cntRT.keys():
-            cntRT[key]=0
-    ids={key:key for key in cntBase.keys()}
-    # Construct dataframe
-    dfCnt=pd.DataFrame(
-            {"id":ids,"count_base":cntBase,"count_readthrough":cntRT})
-    return dfCnt,dictTails
+def _count_segment(chrom,start,cigar):
+    """
+    Count the match operations of an alignment that overlap each feature,
+    using the exon index set by _init_worker.
+    chrom: the reference name of the alignment
+    start: the leftmost reference position of the alignment
+    cigar: the alignment CIGAR as a tuple of (OPERATION,LENGTH) tuples
+    Returns an (ID,LEN) tuple of the overlapped feature id and the overlap
+    length. ID is None if no feature is overlapped, and ID_MULTI if more than
+    one feature is overlapped, in which case counting stops.
+    """
+
+    idSeg=None
+    lenSeg=0
+    for listMatches in _match_spans(cigar):
+        # Query the span once, then clip to each match operation, working in
+        # offsets from the alignment start
+        for st,en,idFeat in _overlap(
+                chrom,start+listMatches[0][0],start+listMatches[-1][1]):
+            st-=start
+            en-=start
+            for opStart,opEnd in listMatches:
+                # Conditional expressions avoid the builtin min/max calls
+                lenOverlap=(en if en<opEnd else opEnd)-\
+                        (st if st>opStart else opStart)
+                if lenOverlap>0:
+                    if idFeat!=idSeg:
+                        if idSeg is not None:
+                            return (ID_MULTI,0)
+                        idSeg=idFeat
+                    lenSeg+=lenOverlap
+    return (idSeg,lenSeg)
+
+@ft.lru_cache(maxsize=SIZE_CACHE_OVERLAP)
+def _overlap(chrom,start,end):
+    """
+    Query the exon index set by _init_worker for the intervals overlapping a
+    reference interval. Results are cached, since neighboring templates often
+    share spans.
+    Returns a tuple of (START,END,ID) tuples, where ID is a feature id.
+    """
+
+    return tuple(_STATE["exons"].overlap(chrom,start,end))
+
+@ft.lru_cache(maxsize=SIZE_CACHE_CIGAR)
+def _match_spans(cigar):
+    """
+    Group the match operations of an alignment into spans that contain no
+    skips.
+    cigar: the alignment CIGAR as a tuple of (OPERATION,LENGTH) tuples
+    Returns a tuple of spans, each of which is a tuple of the (START,END)
+    reference intervals of its match operations, as offsets from the leftmost
+    reference position of the alignment. Within a span, the match operations
+    are separated only by operations other than skips. Results are cached,
+    since a few CIGARs account for most alignments.
+    """
+
+    listSpans=[]
+    listMatches=[]
+    opStart=0
+    for op,length in cigar:
+        opEnd=opStart+length
+        if (MOPS_MASK>>op)&1:
+            listMatches.append((opStart,opEnd))
+        elif (SOPS_MASK>>op)&1 and len(listMatches)>0:
+            listSpans.append(tuple(listMatches))
+            listMatches=[]
+        if (ROPS_MASK>>op)&1:
+            opStart=opEnd
+    if len(listMatches)>0:
+        listSpans.append(tuple(listMatches))
+    return tuple(listSpans)
 
 def _msg(message):
     """
-    Print a string with date and time.
+    Log a progress message at the INFO level. The date and time are added by
+    the logging handler.
     """
-    txt="\t".join([str(dt.datetime.now()),message])
-    print(txt)
+    LOGGER.info(message)
 
 def writeBAMwithOpts(writer,pair,opts):
     """
-    Writes a pair of BAM alignment with the HTSeq BAM writer, 
+    Writes a pair of BAM alignment with the pysam BAM writer, 
     adding optional fields.
-    writer: an HTSeq BAM writer. If None, we do nothing.
-    pair: an iterable of HTSeq SAM alignments
+    writer: a pysam BAM writer. If None, we do nothing.
+    pair: an iterable of pysam alignments, in which missing mates are None
     opts: a list of optional fields in the format [[TAG,TYPE,VALUE],...]
-        The TAG and TYPE elements must be strings. If the VALUE element is
-        not a string already, it will be converted to a string.
+        The TAG and TYPE elements must be strings, and the VALUE element
+        must be of the SAM type given by TYPE.
     """
 
     if writer is None:
         return
 
-    # Convert optional field VALUE to string if needed
-    for i in range(len(opts)):
-        opts[i][2]=str(opts[i][2])
-
     for aln in pair:
 
-        # Construct the SAM alignment with new optional fields
-        line=aln.get_sam_line()
-        for opt in opts:
-            line="\t".join([line,":".join(opt)])
-        aln_new=ht.SAM_Alignment.from_SAM_line(line)
+        if aln is None:
+            continue
 
-        # Write the line
-        writer.write(aln_new)
+        # Add the optional fields to the alignment and write it
+        for tag,typ,val in opts:
+            aln.set_tag(tag,val,value_type=typ)
+        writer.write(aln)
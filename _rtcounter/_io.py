@@ -1,12 +1,149 @@
+import itertools as it
+import numpy as np
+import os
+import zipfile
+
 def _tails2file(dictTails,path):
     """
     Write the readthrough tails dictionary object to a file.
     """
 
-    fileTails=open(path,mode="w",newline="\n")
-    for key in dictTails.keys():
-        tails=[str(val) for val in dictTails[key]]
-        line="".join([" ".join([key," ".join(tails)]),"\n"])
-        fileTails.writelines(line)
-    fileTails.close()
+    # Tail lengths are kept as integers until they are written, and the
+    # lines of all features are joined into one string for a single write
+    with open(path,mode="w",newline="\n") as fileTails:
+        fileTails.write("".join([
+            "".join([key," "," ".join(map(str,tails)),"\n"])
+            for key,tails in dictTails.items()]))
+
+def _bundle_pairs(alignments):
+    """
+    Iterate over name-sorted paired-end pysam alignments, yielding one bundle
+    per read name. Each bundle is a list of (FIRST,SECOND) mate tuples, in
+    which a mate that could not be found is None. Mates are matched as in
+    HTSeq.pair_SAM_alignments.
+    alignments: an iterable of pysam alignments sorted by read name
+    """
+
+    for name,group in it.groupby(alignments,key=lambda aln:aln.query_name):
+        listAln=list(group)
+        for aln in listAln:
+            if not aln.is_paired:
+                raise ValueError("".join(["Read ",name,
+                    " is not a paired-end alignment."]))
+            if aln.is_read1==aln.is_read2:
+                raise ValueError("".join(["Read ",name,
+                    " is neither the first nor the second mate."]))
+        yield list(_pair_mates(listAln))
+
+def _pair_mates(listAln):
+    """
+    Match the alignments sharing one read name into mate tuples.
+    listAln: a list of pysam alignments with the same read name
+    """
+
+    while len(listAln)>0:
+        a1=listAln.pop(0)
+        # Find its mate
+        for a2 in listAln:
+            if a1.is_read1==a2.is_read1:
+                continue
+            if a1.is_unmapped!=a2.mate_is_unmapped or \
+                    a1.mate_is_unmapped!=a2.is_unmapped:
+                continue
+            if a1.is_unmapped or a2.is_unmapped:
+                break
+            if (a1.reference_id==a2.next_reference_id and \
+                    a1.reference_start==a2.next_reference_start and \
+                    a2.reference_id==a1.next_reference_id and \
+                    a2.reference_start==a1.next_reference_start):
+                break
+        else:
+            a2=None
+        if a2 is not None:
+            listAln.remove(a2)
+        if a1.is_read1:
+            yield (a1,a2)
+        else:
+            yield (a2,a1)
+
+def _chunk(iterable,size):
+    """
+    Iterate over lists of up to size consecutive items of an iterable.
+    """
+
+    iterator=iter(iterable)
+    while True:
+        chunk=list(it.islice(iterator,size))
+        if len(chunk)==0:
+            return
+        yield chunk
+
+def _features2file(path,pathToGTF,listNames,dictExons,ivBounds):
+    """
+    Write the features read from a feature file to a numpy .npz cache, keyed
+    by the absolute path, size and modification time of the feature file.
+    path: the path of the cache
+    pathToGTF: the path of the feature file
+    listNames, dictExons, ivBounds: the features, as returned by
+        _counting._read_features
+    """
+
+    stat=os.stat(pathToGTF)
+    listKeys=list(dictExons.keys())
+    listIv=[iv for key in listKeys for iv in dictExons[key]]
+    # Write through a file object, so that no .npz suffix is added to path
+    with open(path,mode="wb") as fileCache:
+        np.savez(fileCache,
+                path=np.array(os.path.abspath(pathToGTF),dtype=str),
+                key=np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64),
+                names=np.array(listNames,dtype=str),
+                chroms=np.array([key[0] for key in listKeys],dtype=str),
+                ids=np.array([key[1] for key in listKeys],dtype=np.int64),
+                counts=np.array([len(dictExons[key]) for key in listKeys],
+                    dtype=np.int64),
+                starts=np.array([iv[0] for iv in listIv],dtype=np.int64),
+                ends=np.array([iv[1] for iv in listIv],dtype=np.int64),
+                boundStart=ivBounds[0],boundEnd=ivBounds[1],
+                boundStrand=ivBounds[2])
+
+def _file2features(path,pathToGTF):
+    """
+    Read the features cached by _features2file.
+    path: the path of the cache
+    pathToGTF: the path of the feature file
+    Returns the features as returned by _counting._read_features, or None if
+    the cache does not exist, cannot be read, or was written for another
+    feature file or for a version of the feature file that has since changed.
+    """
 
+    if not os.path.exists(path):
+        return None
+    stat=os.stat(pathToGTF)
+    # A truncated, corrupt or foreign cache is treated as a missing cache, so
+    # that the features are read again and the cache is rewritten
+    try:
+        cache=np.load(path)
+    except (OSError,ValueError,EOFError,zipfile.BadZipFile):
+        return None
+    if not isinstance(cache,np.lib.npyio.NpzFile):
+        return None
+    try:
+        with cache:
+            if cache["path"].item()!=os.path.abspath(pathToGTF) or \
+                    cache["key"].tolist()!=[stat.st_size,stat.st_mtime_ns]:
+                return None
+            listNames=cache["names"].tolist()
+            listStarts=cache["starts"].tolist()
+            listEnds=cache["ends"].tolist()
+            dictExons={}
+            pos=0
+            for chrom,idFeat,cnt in zip(cache["chroms"].tolist(),
+                    cache["ids"].tolist(),cache["counts"].tolist()):
+                dictExons[(chrom,idFeat)]=list(zip(listStarts[pos:pos+cnt],
+                    listEnds[pos:pos+cnt]))
+                pos+=cnt
+            ivBounds=(cache["boundStart"],cache["boundEnd"],
+                cache["boundStrand"])
+    except (OSError,ValueError,EOFError,KeyError,zipfile.BadZipFile):
+        return None
+    return listNames,dictExons,ivBounds